@@ -6,22 +6,66 @@
 */
 module tb ();
 
-  // Dump the signals to a VCD file. You can view it with gtkwave or surfer.
-  initial begin
-    $dumpfile("tb.vcd");
-    $dumpvars(0, tb);
-    #1;
-  end
-
   // Wire up the inputs and outputs:
   reg clk;
   reg rst_n;
   reg ena;
-  reg [7:0] ui_in;
   reg [7:0] uio_in;
   wire [7:0] uo_out;
   wire [7:0] uio_out;
   wire [7:0] uio_oe;
+
+  // 10 MHz clock, generated here rather than from test.py
+  initial clk = 1'b0;
+  always #50 clk = ~clk;
+
+  // SPI master driving nCS, COPI and SCLK (ui_in[2:0]), so test.py only
+  // has to load spi_word and raise spi_go for each transaction.
+  reg  [15:0] spi_word;
+  reg         spi_go;
+  wire        spi_done;
+  wire        spi_sclk;
+  wire        spi_copi;
+  wire        spi_ncs;
+  initial spi_go = 1'b0;
+
+  // ui_in[7:3] are unused by the project, tie them off
+  wire [7:0]  ui_in = {5'b0, spi_ncs, spi_copi, spi_sclk};
+
+  tb_spi_master spi_master (
+      .clk  (clk),
+      .rst_n(rst_n),
+      .go   (spi_go),
+      .word (spi_word),
+      .done (spi_done),
+      .sclk (spi_sclk),
+      .copi (spi_copi),
+      .ncs  (spi_ncs)
+  );
+
+  // PWM period / high time totals of all 16 outputs, see tb_pwm_monitor.v.
+  // Channel n has its 32-bit counters in bits [32*n +: 32] of each bus.
+  wire [15:0]  pwm_out = {uio_out, uo_out};
+  wire [511:0] pwm_periods;
+  wire [511:0] pwm_period_sum;
+  wire [511:0] pwm_highs;
+  wire [511:0] pwm_high_sum;
+
+  genvar i;
+  generate
+    for (i = 0; i < 16; i = i + 1) begin : pwm_monitor
+      tb_pwm_monitor monitor (
+          .clk       (clk),
+          .rst_n     (rst_n),
+          .pwm       (pwm_out[i]),
+          .periods   (pwm_periods[32*i+:32]),
+          .period_sum(pwm_period_sum[32*i+:32]),
+          .highs     (pwm_highs[32*i+:32]),
+          .high_sum  (pwm_high_sum[32*i+:32])
+      );
+    end
+  endgenerate
+
 `ifdef GL_TEST
   wire VPWR = 1'b1;
   wire VGND = 1'b0;
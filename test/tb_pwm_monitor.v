@@ -0,0 +1,52 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* PWM measurement used by the testbench, so the cocotb test.py does not
+   have to watch every edge of a PWM output itself. Keeps running totals,
+   in clk cycles, of every complete period and high phase of pwm, so the
+   average over any window is the difference of two samples. Nothing is
+   counted before the first rising edge, whose period would be bogus.
+*/
+module tb_pwm_monitor (
+    input  wire        clk,
+    input  wire        rst_n,
+    input  wire        pwm,
+    output reg  [31:0] periods,     // complete periods seen so far
+    output reg  [31:0] period_sum,  // clk cycles of those periods
+    output reg  [31:0] highs,       // complete high phases seen so far
+    output reg  [31:0] high_sum     // clk cycles of those high phases
+);
+
+  reg        pwm_q;
+  reg        seen_rise;
+  reg [31:0] since_rise;
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      pwm_q      <= 1'b0;
+      seen_rise  <= 1'b0;
+      since_rise <= 32'd0;
+      periods    <= 32'd0;
+      period_sum <= 32'd0;
+      highs      <= 32'd0;
+      high_sum   <= 32'd0;
+    end else begin
+      pwm_q      <= pwm;
+      since_rise <= since_rise + 32'd1;
+      if (pwm && !pwm_q) begin
+        // Rising edge
+        seen_rise  <= 1'b1;
+        since_rise <= 32'd0;
+        if (seen_rise) begin
+          periods    <= periods + 32'd1;
+          period_sum <= period_sum + since_rise + 32'd1;
+        end
+      end else if (!pwm && pwm_q && seen_rise) begin
+        // Falling edge
+        highs    <= highs + 32'd1;
+        high_sum <= high_sum + since_rise + 32'd1;
+      end
+    end
+  end
+
+endmodule
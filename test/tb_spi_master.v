@@ -0,0 +1,93 @@
+`default_nettype none
+`timescale 1ns / 1ps
+
+/* SPI master used by the testbench, so the cocotb test.py does not have to
+   bit-bang SCLK and COPI itself. Raising go shifts out word MSB first:
+   nCS is pulled low, then every bit is held for HALF_SCLK_CYCLES with SCLK
+   low followed by HALF_SCLK_CYCLES with SCLK high. When the last bit is
+   done nCS is released and done stays high until go is lowered again.
+*/
+module tb_spi_master #(
+    parameter HALF_SCLK_CYCLES = 50  // 5 us at the 10 MHz test clock
+) (
+    input  wire        clk,
+    input  wire        rst_n,
+    input  wire        go,
+    input  wire [15:0] word,
+    output reg         done,
+    output reg         sclk,
+    output reg         copi,
+    output reg         ncs
+);
+
+  localparam IDLE = 2'd0;
+  localparam LOW  = 2'd1;
+  localparam HIGH = 2'd2;
+  localparam DONE = 2'd3;
+
+  reg [1:0]  state;
+  reg [14:0] shift_reg;
+  reg [3:0]  bit_cnt;
+  reg [7:0]  half_cnt;
+
+  wire half_done = (half_cnt == HALF_SCLK_CYCLES - 1);
+
+  always @(posedge clk or negedge rst_n) begin
+    if (!rst_n) begin
+      state     <= IDLE;
+      shift_reg <= 15'd0;
+      bit_cnt   <= 4'd0;
+      half_cnt  <= 8'd0;
+      done      <= 1'b0;
+      sclk      <= 1'b0;
+      copi      <= 1'b0;
+      ncs       <= 1'b1;
+    end else begin
+      case (state)
+        IDLE: begin
+          if (go) begin
+            // Pull CS low with the first bit already on COPI
+            ncs       <= 1'b0;
+            copi      <= word[15];
+            shift_reg <= word[14:0];
+            bit_cnt   <= 4'd0;
+            half_cnt  <= 8'd0;
+            state     <= LOW;
+          end
+        end
+        LOW: begin
+          half_cnt <= half_done ? 8'd0 : half_cnt + 8'd1;
+          if (half_done) begin
+            sclk  <= 1'b1;
+            state <= HIGH;
+          end
+        end
+        HIGH: begin
+          half_cnt <= half_done ? 8'd0 : half_cnt + 8'd1;
+          if (half_done) begin
+            sclk <= 1'b0;
+            if (bit_cnt == 4'd15) begin
+              // Last bit clocked out, release CS
+              ncs   <= 1'b1;
+              copi  <= 1'b0;
+              done  <= 1'b1;
+              state <= DONE;
+            end else begin
+              copi      <= shift_reg[14];
+              shift_reg <= {shift_reg[13:0], 1'b0};
+              bit_cnt   <= bit_cnt + 4'd1;
+              state     <= LOW;
+            end
+          end
+        end
+        DONE: begin
+          if (!go) begin
+            done  <= 1'b0;
+            state <= IDLE;
+          end
+        end
+      endcase
+    end
+  end
+
+endmodule
@@ -1,28 +1,49 @@
 # SPDX-FileCopyrightText: © 2024 Tiny Tapeout
 # SPDX-License-Identifier: Apache-2.0
 
+from functools import lru_cache
+
 import cocotb
-from cocotb.clock import Clock
 from cocotb.triggers import RisingEdge
-from cocotb.triggers import ClockCycles
-from cocotb.types import Logic
-from cocotb.types import LogicArray
-
-async def await_half_sclk(dut):
-    """Wait for the SCLK signal to go high or low."""
-    start_time = cocotb.utils.get_sim_time(units="ns")
-    while True:
-        await ClockCycles(dut.clk, 1)
-        # Wait for half of the SCLK period (10 us)
-        if (start_time + 100*100*0.5) < cocotb.utils.get_sim_time(units="ns"):
-            break
-    return
-
-def ui_in_logicarray(ncs, bit, sclk):
-    """Setup the ui_in value as a LogicArray."""
-    return LogicArray(f"00000{ncs}{bit}{sclk}")
-
-async def send_spi_transaction(dut, r_w, address, data):
+from cocotb.triggers import FallingEdge
+from cocotb.triggers import Edge
+from cocotb.triggers import First
+from cocotb.triggers import Timer
+
+# Test clock period (10 MHz, generated in tb.v), kept integer so ns
+# arithmetic stays exact
+_CLK_PERIOD_NS = 100
+
+async def wait_cycles(num_cycles):
+    """Wait num_cycles clock periods on one Timer instead of every clock edge."""
+    await Timer(num_cycles * _CLK_PERIOD_NS, units="ns")
+
+# Clock cycles nCS is held high between frames of a burst
+_NCS_GAP_CYCLES = 4
+
+async def send_spi_frame(dut, word):
+    """Clock out one CS-low 16-bit frame, leaving CS high afterwards."""
+    spi_go = dut.spi_go
+    spi_done = dut.spi_done
+    # tb_spi_master.v drives nCS, SCLK and COPI for the whole frame
+    dut.spi_word.value = word
+    spi_go.value = 1
+    await RisingEdge(spi_done)
+    # Wait for the master to return to idle before the next frame
+    spi_go.value = 0
+    await FallingEdge(spi_done)
+
+@lru_cache(maxsize=None)
+def spi_word(r_w, address, data_int):
+    """Validate a transaction and return it as one 16-bit word, MSB first."""
+    if address < 0 or address > 127:
+        raise ValueError("Address must be 7-bit (0-127)")
+    if data_int < 0 or data_int > 255:
+        raise ValueError("Data must be 8-bit (0-255)")
+    # RW + Address in the first byte, data in the second
+    return (int(r_w) << 15) | (address << 8) | data_int
+
+async def send_spi_transaction(dut, r_w, address, data, tail_cycles=20):
     """
     Send an SPI transaction with format:
     - 1 bit for Read/Write
@@ -32,321 +53,228 @@ async def send_spi_transaction(dut, r_w, address, data):
     Parameters:
     - r_w: boolean, True for write, False for read
     - address: int, 7-bit address (0-127)
-    - data: LogicArray or int, 8-bit data
+    - data: int, 8-bit data
+    - tail_cycles: int, clock cycles to wait after CS is released
     """
-    # Convert data to int if it's a LogicArray
-    if isinstance(data, LogicArray):
-        data_int = int(data)
-    else:
-        data_int = data
-    # Validate inputs
-    if address < 0 or address > 127:
-        raise ValueError("Address must be 7-bit (0-127)")
-    if data_int < 0 or data_int > 255:
-        raise ValueError("Data must be 8-bit (0-255)")
-    # Combine RW and address into first byte
-    first_byte = (int(r_w) << 7) | address
-    # Start transaction - pull CS low
-    sclk = 0
-    ncs = 0
-    bit = 0
-    # Set initial state with CS low
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 1)
-    # Send first byte (RW + Address)
-    for i in range(8):
-        bit = (first_byte >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # Send second byte (Data)
-    for i in range(8):
-        bit = (data_int >> (7-i)) & 0x1
-        # SCLK low, set COPI
-        sclk = 0
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-        # SCLK high, keep COPI
-        sclk = 1
-        dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-        await await_half_sclk(dut)
-    # End transaction - return CS high
-    sclk = 0
-    ncs = 1
-    bit = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
-    await ClockCycles(dut.clk, 600)
-    return ui_in_logicarray(ncs, bit, sclk)
-
-async def PWM_test(dut, signal, channel, num_cycles=3, timeout=5000000):
+    await send_spi_frame(dut, spi_word(r_w, address, data))
+    await wait_cycles(tail_cycles)
+
+async def send_spi_frames(dut, words, tail_cycles):
+    """Send frames back to back, with one settling tail after the last."""
+    for i, word in enumerate(words):
+        if i:
+            await wait_cycles(_NCS_GAP_CYCLES)
+        await send_spi_frame(dut, word)
+    await wait_cycles(tail_cycles)
+
+# Disjoint channel masks, so every channel is checked both enabled and
+# disabled while its neighbours are in the other state
+_CHANNEL_MASKS = (0x55, 0xAA)
+
+def enable_regs(mask):
+    """Output enable and PWM mode set on the channels in mask, on both banks."""
+    return {0x00: mask, 0x01: mask, 0x02: mask, 0x03: mask}
+
+def channel_enabled(mask, channel):
+    """Whether enable_regs(mask) enables channel (0-15)."""
+    return (mask >> (channel % 8)) & 1
+
+async def write_spi_regs(dut, regs, tail_cycles=20):
+    """
+    Write every register in regs, back to back with one settling tail.
+
+    Parameters:
+    - regs: dict, 7-bit address -> 8-bit data
+    - tail_cycles: int, clock cycles to wait after CS is released
+    """
+    words = [spi_word(1, address, data) for address, data in regs.items()]
+    await send_spi_frames(dut, words, tail_cycles)
+
+def pwm_totals(dut, channel):
+    """Return the (periods, period_sum, highs, high_sum) tb_pwm_monitor counters of a channel."""
+    return [(int(bus.value) >> (32 * channel)) & 0xFFFFFFFF
+            for bus in (dut.pwm_periods, dut.pwm_period_sum, dut.pwm_highs, dut.pwm_high_sum)]
+
+async def PWM_test(dut, channel, num_cycles=3, expected_period_ns=333333):
     """
     Sample and return freq and DC of PWM output
+
+    The edges are timed by tb_pwm_monitor.v, this only waits for
+    num_cycles + 2 expected periods and averages every period and high
+    phase that ended in that window; the extra periods leave room for the
+    phase of the output and a slower than expected clock. A channel
+    without a complete period in the first three periods is stuck at 0%
+    or 100% and is reported right away.
     """
-    last_val = (int(signal.value) >> channel) & 1
-
-    rising_edge = []
-    time_high = []
-
-    last_rise = None
-
-    start_time = cocotb.utils.get_sim_time(units="ns")
-
-    while len(rising_edge) - 1 < num_cycles:
-        await ClockCycles(dut.clk, 1)
-        now = cocotb.utils.get_sim_time(units="ns")
-
-        curr_val = (int(signal.value) >> channel) & 1
-        
-        if now - start_time > timeout:
-            return 1.0 if curr_val == 1 else 0.0, 0
-        
-        if curr_val == 1 and last_val == 0:
-            #rising edge
-            rising_edge.append(now)
-            
-            last_rise = now
-        elif curr_val == 0 and last_val == 1:
-            #falling edge
-            if last_rise is not None:
-                time_high.append(now - last_rise)
-        
-        last_val = curr_val
-
-    periods = []
-    for t1, t2 in zip(rising_edge, rising_edge[1:]):
-        periods.append(t2-t1)
-
-    avg_period = sum(periods)/len(periods)
-    avg_tHigh = sum(time_high)/len(time_high)
-
-    if avg_period > 0:
-        duty = avg_tHigh/avg_period
-        freq = (1E9)/avg_period
-    else:
-        duty = 0
-        freq = 0
-    
-    return duty, freq
+    start = pwm_totals(dut, channel)
 
-@cocotb.test()
-async def test_spi(dut):
-    dut._log.info("Start SPI test")
+    def totals_since_start():
+        # The counters start at reset and do not wrap within a test
+        return [end - begin for end, begin in zip(pwm_totals(dut, channel), start)]
 
-    # Set the clock period to 100 ns (10 MHz)
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
+    await Timer(3 * expected_period_ns, units="ns")
+    periods, _, highs, _ = totals_since_start()
 
-    # Reset
+    if periods < 1 or highs < 1:
+        return 1.0 if (int(dut.pwm_out.value) >> channel) & 1 else 0.0, 0
+    if num_cycles > 1:
+        await Timer((num_cycles - 1) * expected_period_ns, units="ns")
+
+    periods, period_sum, highs, high_sum = totals_since_start()
+    period = period_sum / periods
+    tHigh = high_sum / highs
+
+    duty = tHigh/period
+    freq = (1E9)/(period * _CLK_PERIOD_NS)
+
+    return duty, freq
+
+async def is_constant(sig, target: int, sample_cycles: int = 7000) -> bool:
+    """Check sig is at target and does not toggle for sample_cycles."""
+    if int(sig.value) != target:
+        return False
+    # Any toggle within the window ends the wait on the Edge instead
+    window = Timer(sample_cycles * _CLK_PERIOD_NS, units="ns")
+    return await First(Edge(sig), window) is window
+
+async def reset_dut(dut):
+    """Reset the design."""
     dut._log.info("Reset")
     dut.ena.value = 1
-    ncs = 1
-    bit = 0
-    sclk = 0
-    dut.ui_in.value = ui_in_logicarray(ncs, bit, sclk)
     dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
+    await wait_cycles(5)
     dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
+    await wait_cycles(5)
+
+@cocotb.test()
+async def test_spi(dut):
+    dut._log.info("Start SPI test")
+
+    await reset_dut(dut)
 
     dut._log.info("Test project behavior - SPI")
     dut._log.info("Write transaction, address 0x00, data 0xF0")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
+    await send_spi_transaction(dut, 1, 0x00, 0xF0)  # Write transaction
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 1000) 
+    await wait_cycles(1000)
 
     dut._log.info("Write transaction, address 0x01, data 0xCC")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
+    await send_spi_transaction(dut, 1, 0x01, 0xCC)  # Write transaction
     assert dut.uio_out.value == 0xCC, f"Expected 0xCC, got {dut.uio_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await wait_cycles(100)
 
     dut._log.info("Write transaction, address 0x30 (invalid), data 0xAA")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x30, 0xAA)
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 1, 0x30, 0xAA)
+    await wait_cycles(100)
 
     dut._log.info("Read transaction (invalid), address 0x00, data 0xBE")
-    ui_in_val = await send_spi_transaction(dut, 0, 0x30, 0xBE)
+    await send_spi_transaction(dut, 0, 0x30, 0xBE)
     assert dut.uo_out.value == 0xF0, f"Expected 0xF0, got {dut.uo_out.value}"
-    await ClockCycles(dut.clk, 100)
+    await wait_cycles(100)
     
     dut._log.info("Read transaction (invalid), address 0x41 (invalid), data 0xEF")
-    ui_in_val = await send_spi_transaction(dut, 0, 0x41, 0xEF)
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 0, 0x41, 0xEF)
+    await wait_cycles(100)
 
     dut._log.info("Write transaction, address 0x02, data 0xFF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 100)
+    await send_spi_transaction(dut, 1, 0x02, 0xFF)  # Write transaction
+    await wait_cycles(100)
 
     dut._log.info("Write transaction, address 0x04, data 0xCF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0xCF)  # Write transaction
+    await wait_cycles(30000)
 
     dut._log.info("Write transaction, address 0x04, data 0xFF")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0xFF)  # Write transaction
+    await wait_cycles(30000)
 
     dut._log.info("Write transaction, address 0x04, data 0x00")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0x00)  # Write transaction
+    await wait_cycles(30000)
 
     dut._log.info("Write transaction, address 0x04, data 0x01")
-    ui_in_val = await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
-    await ClockCycles(dut.clk, 30000)
+    await send_spi_transaction(dut, 1, 0x04, 0x01)  # Write transaction
+    await wait_cycles(30000)
 
     dut._log.info("SPI test completed successfully")
 
 @cocotb.test()
 async def test_pwm_freq(dut):
     # Write your test here
-    # Clock
-    clock = Clock(dut.clk, 100, units="ns")
-    cocotb.start_soon(clock.start())
-
-    # Reset
-    dut._log.info("Reset")
-    dut.ena.value = 1
-    dut.ui_in.value = ui_in_logicarray(1, 0, 0)  # nCS=1, bit=0, sclk=0
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
-
-    async def wait_for_level(bit_handle, level: int, max_cycles: int):
-        for _ in range(max_cycles):
-            await RisingEdge(dut.clk)
-            if int(bit_handle.value) == level:
-                return cocotb.utils.get_sim_time(units="ns")
-        raise AssertionError(f"Timeout waiting for level {level}")
-
-    async def measure_freq(bus_handle, bit_idx: int) -> float:
-        sig = bus_handle[bit_idx]
-        await wait_for_level(sig, 0, 10000)
-        t1 = await wait_for_level(sig, 1, 10000)
-        await wait_for_level(sig, 0, 10000)
-        t2 = await wait_for_level(sig, 1, 10000)
-        period_ns = t2 - t1
-        assert period_ns > 0, "Non-positive period measured"
-        return 1e9 / period_ns
-
-    
-    await send_spi_transaction(dut, 1, 0x04, 0x80)
-
-    # Clear enables
-    for reg in (0x00, 0x01, 0x02, 0x03):
-        await send_spi_transaction(dut, 1, reg, 0x00)
-
-    banks = [
-        (0x00, 0x02, dut.uo_out, 0),   
-        (0x01, 0x03, dut.uio_out, 8),  
-    ]
-
-    dut._log.info("Testing PWM frequency on all channels")
-    for en_reg, mode_reg, bus, base in banks:
-        for i in range(8):
-            ch = base + i
-
-            await send_spi_transaction(dut, 1, en_reg,  1 << i)
-            await send_spi_transaction(dut, 1, mode_reg, 1 << i)
-            await ClockCycles(dut.clk, 2000)
-
-            freq = await measure_freq(bus, i)
-            assert 2970 <= freq <= 3030, (
-                f"Channel {ch}: measured {freq:.1f} Hz; expected 3000 Hz ±1%"
-            )
-
-            await send_spi_transaction(dut, 1, en_reg,  0x00)
-            await send_spi_transaction(dut, 1, mode_reg, 0x00)
-
-    await send_spi_transaction(dut, 1, 0x04, 0x00)
+    await reset_dut(dut)
+    sigs = [bus[i] for bus in (dut.uo_out, dut.uio_out) for i in range(8)]
+
+    for mask in _CHANNEL_MASKS:
+        # 50% duty, enable output and PWM mode on the channels in mask
+        await write_spi_regs(dut, {0x04: 0x80, **enable_regs(mask)})
+        await wait_cycles(2000)
+
+        dut._log.info(f"Testing PWM frequency with channel mask 0x{mask:02X}")
+        tasks = [
+            cocotb.start_soon(PWM_test(dut, ch, num_cycles=1) if channel_enabled(mask, ch)
+                              else is_constant(sig, 0, sample_cycles=5000))
+            for ch, sig in enumerate(sigs)
+        ]
+        for ch, task in enumerate(tasks):
+            if channel_enabled(mask, ch):
+                _, freq = await task
+                assert 2970 <= freq <= 3030, (
+                    f"Channel {ch}: measured {freq:.1f} Hz; expected 3000 Hz ±1%"
+                )
+            else:
+                assert await task, f"Channel {ch}: disabled but not held LOW"
+
+    await write_spi_regs(dut, {0x04: 0x00})
     dut._log.info("PWM frequency test completed successfully on all 16 channels")
 
 @cocotb.test()
 async def test_pwm_duty(dut):
     # Write your test here
     """Verify PWM duty = 0%, 50%, 100% on all 16 channels."""
-    # Clock & reset
-    clock = Clock(dut.clk, 100, units="ns")  
-    cocotb.start_soon(clock.start())
-
-    dut.ena.value = 1
-    dut.ui_in.value = ui_in_logicarray(1, 0, 0)
-
-    dut.rst_n.value = 0
-    await ClockCycles(dut.clk, 5)
-    dut.rst_n.value = 1
-    await ClockCycles(dut.clk, 5)
-
-    async def wait_for_level(sig, level: int, max_cycles: int) -> int:
-        for _ in range(max_cycles):
-            await RisingEdge(dut.clk)
-            if int(sig.value) == level:
-                return cocotb.utils.get_sim_time(units="ns")
-        raise AssertionError(f"Timeout waiting for level {level}")
-
-    async def measure_duty(sig, max_cycles: int = 20000) -> tuple[float, float]:
-        await wait_for_level(sig, 0, max_cycles)
-        t1 = await wait_for_level(sig, 1, max_cycles)  
-        tf = await wait_for_level(sig, 0, max_cycles)  
-        t2 = await wait_for_level(sig, 1, max_cycles)  
-        high_ns = tf - t1
-        period_ns = t2 - t1
-        assert period_ns > 0, "Non-positive period measured"
-        return (high_ns / period_ns, period_ns)
-
-    async def is_constant(sig, target: int, sample_cycles: int = 7000) -> bool:
-        for _ in range(sample_cycles):
-            await RisingEdge(dut.clk)
-            if int(sig.value) != target:
-                return False
-        return True
-
-    # Clear enables
-    for reg in (0x00, 0x01, 0x02, 0x03):
-        await send_spi_transaction(dut, 1, reg, 0x00)
-
-    banks = [
-        (0x00, 0x02, dut.uo_out, 0),
-        (0x01, 0x03, dut.uio_out, 8),
-    ]
+    await reset_dut(dut)
+    sigs = [bus[i] for bus in (dut.uo_out, dut.uio_out) for i in range(8)]
 
     tol_pct = 1.0
-    for en_reg, mode_reg, bus, base in banks:
-        for i in range(8):
-            ch = base + i
-
-            await send_spi_transaction(dut, 1, en_reg,  1 << i)
-            await send_spi_transaction(dut, 1, mode_reg, 1 << i)
-
-            
-            await send_spi_transaction(dut, 1, 0x04, 0x00)
-            await ClockCycles(dut.clk, 7000)
-            sig = bus[i]
-            ok0 = await is_constant(sig, 0, sample_cycles=5000)
+
+    for mask in _CHANNEL_MASKS:
+        dut._log.info(f"Testing PWM duty cycle with channel mask 0x{mask:02X}")
+        await write_spi_regs(dut, {0x04: 0x00, **enable_regs(mask)})
+        await wait_cycles(7000)
+        tasks = [cocotb.start_soon(is_constant(sig, 0, sample_cycles=5000)) for sig in sigs]
+        for ch, task in enumerate(tasks):
+            ok0 = await task
             assert ok0, f"Channel {ch}: expected 0% (always LOW), but it toggled"
 
-            
-            await send_spi_transaction(dut, 1, 0x04, 0x80)
-            await ClockCycles(dut.clk, 7000)
-            duty, period_ns = await measure_duty(sig)
+        await write_spi_regs(dut, {0x04: 0x80})
+        await wait_cycles(7000)
+        tasks = [
+            cocotb.start_soon(PWM_test(dut, ch, num_cycles=1) if channel_enabled(mask, ch)
+                              else is_constant(sig, 0, sample_cycles=5000))
+            for ch, sig in enumerate(sigs)
+        ]
+        for ch, task in enumerate(tasks):
+            if not channel_enabled(mask, ch):
+                assert await task, f"Channel {ch}: disabled but not held LOW"
+                continue
+            duty, freq = await task
             duty_pct = duty * 100.0
             assert (50 - tol_pct) <= duty_pct <= (50 + tol_pct), (
                 f"Channel {ch}: 50% test failed — measured {duty_pct:.2f}% "
-                f"(period {period_ns:.1f} ns), expected 50% ±{tol_pct}%"
+                f"({freq:.1f} Hz), expected 50% ±{tol_pct}%"
             )
 
-            
-            await send_spi_transaction(dut, 1, 0x04, 0xFF)
-            await ClockCycles(dut.clk, 7000)
-            ok1 = await is_constant(sig, 1, sample_cycles=5000)
-            assert ok1, f"Channel {ch}: expected 100% (always HIGH), but it toggled"
-
-            await send_spi_transaction(dut, 1, en_reg,  0x00)
-            await send_spi_transaction(dut, 1, mode_reg, 0x00)
-
-    await send_spi_transaction(dut, 1, 0x04, 0x00)
+        await write_spi_regs(dut, {0x04: 0xFF})
+        await wait_cycles(7000)
+        tasks = [
+            cocotb.start_soon(is_constant(sig, channel_enabled(mask, ch), sample_cycles=5000))
+            for ch, sig in enumerate(sigs)
+        ]
+        for ch, task in enumerate(tasks):
+            ok1 = await task
+            if channel_enabled(mask, ch):
+                assert ok1, f"Channel {ch}: expected 100% (always HIGH), but it toggled"
+            else:
+                assert ok1, f"Channel {ch}: disabled but not held LOW"
+
+    await write_spi_regs(dut, {0x04: 0x00})
     dut._log.info("PWM duty-cycle tests passed on all 16 channels")
-